@@ -0,0 +1,136 @@
+"""Latency of join_class/leave_class during a storm of get_upcoming refreshes.
+
+Starts server.py against a fixture database, lets --readers users refresh get_upcoming
+as fast as they can, and meanwhile has one user join and leave a class a few times a
+second. Prints the write latency percentiles and how the reads were answered (200, or
+shed with 503/429, or reset). Pass --server to measure another revision of server.py, and
+--calm to get the write latencies without the storm.
+
+    python benchmarks/bench_admission.py --readers 32 --duration 10
+"""
+
+import argparse
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+
+import common
+from common import create_fixture_database, start_server
+
+
+def request(port, command, content, cookies=None):
+    """POST /action?command=... and return (status, Retry-After, records, cookies)."""
+    headers = {"Content-Type": "application/json"}
+    if cookies:
+        headers["Cookie"] = "; ".join("%s=%s" % item for item in cookies.items())
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("POST", "/action?command=" + command, json.dumps(content), headers)
+        reply = connection.getresponse()
+        data = reply.read()
+        new_cookies = {}
+        for name, value in reply.getheaders():
+            if name.lower() == "set-cookie":
+                key, _, rest = value.strip().partition("=")
+                new_cookies[key] = rest.split(";")[0]
+        return reply.status, reply.getheader("Retry-After"), json.loads(data) if data else [], new_cookies
+    finally:
+        connection.close()
+
+
+def login(port, userid):
+    """Log in, waiting out the login rate limit of the server."""
+    while True:
+        status, retry_after, _, cookies = request(port, "login", {"username": "user%d" % userid, "password": "pw"})
+        if status == 200:
+            return cookies
+        time.sleep(float(retry_after or 1))
+
+
+def reader(port, cookies, stop, counts, lock):
+    while not stop.is_set():
+        try:
+            status, retry_after, _, _ = request(port, "get_upcoming", {}, cookies)
+        except OSError:
+            # The listen backlog overflowed and the connection was reset.
+            status, retry_after = "reset", None
+        with lock:
+            counts[status] = counts.get(status, 0) + 1
+        if retry_after:
+            time.sleep(min(float(retry_after), 0.2))
+
+
+def writer(port, cookies, class_id, stop, latencies, failures):
+    commands = ("join_class", "leave_class")
+    done = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        status, _, _, _ = request(port, commands[done % 2], {"id": class_id}, cookies)
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            failures.append(status)
+        done += 1
+        time.sleep(0.2)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--server", default=common.SERVER)
+    parser.add_argument("--calm", action="store_true", help="leave out the readers")
+    arguments = parser.parse_args()
+    common.SERVER = arguments.server
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_fixture_database(os.path.join(directory, "database.db"))
+        process = start_server(directory, arguments.port)
+        try:
+            writer_cookies = login(arguments.port, 199)
+            _, _, records, _ = request(arguments.port, "get_upcoming", {}, writer_cookies)
+            class_id = next(record["id"] for record in records if record.get("action") == "join")
+            reader_cookies = [] if arguments.calm else [login(arguments.port, 100 + i) for i in range(arguments.readers)]
+
+            stop = threading.Event()
+            lock = threading.Lock()
+            counts, latencies, failures = {}, [], []
+            threads = [
+                threading.Thread(target=reader, args=(arguments.port, cookies, stop, counts, lock))
+                for cookies in reader_cookies
+            ]
+            threads.append(
+                threading.Thread(
+                    target=writer, args=(arguments.port, writer_cookies, class_id, stop, latencies, failures)
+                )
+            )
+            for thread in threads:
+                thread.start()
+            time.sleep(arguments.duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            process.terminate()
+            process.wait()
+
+    print("writes: %d ok, %d rejected" % (len(latencies), len(failures)))
+    for label, fraction in (("p50", 0.50), ("p90", 0.90), ("p99", 0.99)):
+        print("  %s %8.1f ms" % (label, percentile(latencies, fraction) * 1000))
+    print("  max %8.1f ms" % (max(latencies, default=float("nan")) * 1000))
+    if counts:
+        print("reads: " + ", ".join("%d x %s" % (counts[status], status) for status in sorted(counts, key=str)))
+        print("  %.1f answered per second" % (sum(counts.values()) / arguments.duration))
+
+
+if __name__ == "__main__":
+    main()
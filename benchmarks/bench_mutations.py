@@ -0,0 +1,104 @@
+"""Database round trips of each mutation command.
+
+Runs join_class, leave_class, update_attendee (pass and remove), cancel_class,
+create_class and logout once against a fixture database and counts the SQLite
+connections opened and the SQL statements executed by each, leaving out
+transaction control. Pass --server to measure another revision of server.py,
+e.g. one checked out with `git show <rev>:server.py > /tmp/server_old.py`.
+
+    python benchmarks/bench_mutations.py [--server /tmp/server_old.py]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import time
+
+from common import call_handler, create_fixture_database, load_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA")
+
+
+class Counter:
+    """Wraps sqlite3.connect to count connections and traced statements."""
+
+    def __init__(self):
+        self.connections = 0
+        self.statements = 0
+        self.connect = sqlite3.connect
+
+    def trace(self, statement):
+        if not statement.lstrip().upper().startswith(TRANSACTION_CONTROL):
+            self.statements += 1
+
+    def __call__(self, *args, **kwargs):
+        self.connections += 1
+        db = self.connect(*args, **kwargs)
+        db.set_trace_callback(self.trace)
+        return db
+
+
+def add_scenario(path):
+    now = int(time.time())
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO users VALUES (?,?,?,?)", [(u, "User %d" % u, "user%d" % u, "pw") for u in (901, 902, 903)])
+    db.execute("INSERT INTO class VALUES (9001, 1, 1, ?, 10, 'upcoming')", (now + 86400,))
+    db.execute("INSERT INTO class VALUES (9002, 1, 1, ?, 10, 'finished')", (now - 86400,))
+    db.execute("INSERT INTO attendee VALUES (900001, 902, 9002, 0)")
+    db.execute("INSERT INTO attendee VALUES (900002, 903, 9001, 0)")
+    db.executemany('INSERT INTO "session" VALUES (?,?,?)', [(1, 1, 1111111111), (2, 901, 2222222222)])
+    db.commit()
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", default=os.path.join(ROOT, "server.py"))
+    arguments = parser.parse_args()
+
+    trainer = ("1", "1111111111")
+    user = ("901", "2222222222")
+    commands = [
+        ("join_class", "handle_join_class_request", user, {"id": 9001}),
+        ("leave_class", "handle_leave_class_request", user, {"id": 9001}),
+        ("update_attendee pass", "handle_update_attendee_request", trainer, {"id": 900001, "state": "pass"}),
+        ("update_attendee remove", "handle_update_attendee_request", trainer, {"id": 900002, "state": "remove"}),
+        ("cancel_class", "handle_cancel_class_request", trainer, {"id": 9001}),
+        (
+            "create_class",
+            "handle_create_class_request",
+            trainer,
+            {"id": 1, "note": "new", "max": 5, "day": 1, "month": 1, "year": 2099, "hour": 9, "minute": 0},
+        ),
+        ("logout", "handle_logout_request", user, {}),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "database.db")
+        create_fixture_database(path)
+        add_scenario(path)
+        os.chdir(directory)
+        server = load_server(os.path.abspath(arguments.server))
+        counter = Counter()
+        sqlite3.connect = counter
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Warm up: starts the writer and loads cached data on revisions that have them.
+            call_handler(server.handle_get_upcoming_request, *user, {})
+
+        print("%-24s %12s %11s %10s" % ("command", "connections", "statements", "ms"))
+        for name, handler, (iuser, imagic), content in commands:
+            counter.connections = counter.statements = 0
+            began = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                getattr(server, handler)(iuser, imagic, content)
+            elapsed = (time.perf_counter() - began) * 1000
+            print("%-24s %12d %11d %10.2f" % (name, counter.connections, counter.statements, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Throughput of the pre-fork serving mode from 1 to N worker processes.
+
+Starts server.py against a fixture database once per worker count and drives it
+with concurrent client processes issuing get_upcoming requests, then prints the
+requests per second and the speed-up over a single worker.
+
+    python benchmarks/bench_prefork.py --max-workers 4 --clients 8 --duration 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from common import create_fixture_database, login, post_action, start_server
+
+
+def client(port, userid, duration, results):
+    cookies = login(port, userid)
+    done = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        post_action(port, "get_upcoming", {}, cookies)
+        done += 1
+    results.put(done)
+
+
+def measure(directory, port, workers, clients, duration):
+    process = start_server(directory, port, "--workers", str(workers), "--no-rate-limits")
+    try:
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=client, args=(port, 100 + i, duration, results))
+            for i in range(clients)
+        ]
+        for proc in procs:
+            proc.start()
+        total = sum(results.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+        return total / duration
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--clients", type=int, default=2 * (os.cpu_count() or 1))
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=8091)
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_fixture_database(os.path.join(directory, "database.db"))
+        baseline = None
+        print("%8s %12s %9s" % ("workers", "requests/s", "speed-up"))
+        for workers in range(1, arguments.max_workers + 1):
+            rate = measure(directory, arguments.port + workers, workers, arguments.clients, arguments.duration)
+            baseline = baseline or rate
+            print("%8d %12.1f %8.2fx" % (workers, rate, rate / baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""How the SQL of each handler scales with the size of the database.
+
+Generates databases at --scales times a small base (see generate_database.py), runs
+get_my_skills, get_upcoming, get_class, join_class, leave_class, cancel_class and
+update_attendee once on each to record the statements they execute, and then replays
+every statement on its own: its median time, the SQLite virtual machine steps it takes
+(counted with a progress handler, a stand-in for the rows it scans) and its query plan.
+Write statements are replayed in a transaction that is rolled back, and the database is
+restored after each write command, so every command sees the same data.
+
+The table lists each command's totals per scale and the growth exponent between the two
+largest scales (0 means flat, 1 linear in the data). Commands that grow faster than
+linearly are flagged. --save keeps the results as JSON, and --baseline compares them with
+results saved from another revision (run with --server):
+
+    git show HEAD~5:server.py > /tmp/server_old.py
+    python benchmarks/bench_queries.py --server /tmp/server_old.py --save /tmp/old.json
+    python benchmarks/bench_queries.py --baseline /tmp/old.json --plans
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import time
+
+from common import call_handler, load_server
+from generate_database import generate_database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The database at scale 1. Only users and skills are multiplied by the scale, so each
+# user's classes stay the same: per-user queries should stay flat as the tables grow.
+BASE = {"users": 20, "skills": 2}
+PER_SKILL = {"users_per_skill": 15, "classes_per_skill": 10, "trainers_per_skill": 1}
+
+SKIPPED = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA", "--")
+MAGIC = "1234567890"
+# A growth exponent above this between two scales is flagged as super-linear.
+SUPER_LINEAR = 1.15
+# The progress handler is called every this many VM steps, so counts are rounded down to it.
+STEP_GRANULARITY = 16
+
+
+class Recorder:
+    """Wraps sqlite3.connect to record the statements run while recording is on."""
+
+    def __init__(self):
+        self.connect = sqlite3.connect
+        self.recording = None
+
+    def trace(self, statement):
+        if self.recording is None or statement.lstrip().upper().startswith(SKIPPED):
+            return
+        # Statements that fire triggers are traced again for each trigger.
+        if not self.recording or self.recording[-1] != statement:
+            self.recording.append(statement)
+
+    def __call__(self, *args, **kwargs):
+        db = self.connect(*args, **kwargs)
+        db.set_trace_callback(self.trace)
+        return db
+
+
+def pick_samples(db):
+    """Choose the users, classes and attendees the commands are run with."""
+    now = int(time.time())
+    one = lambda query, *parameters: db.execute(query, parameters).fetchone()  # noqa: E731
+    (user,) = one(
+        "SELECT userid FROM attendee WHERE userid NOT IN (SELECT trainerid FROM trainer) "
+        "GROUP BY userid ORDER BY COUNT(*) DESC, userid LIMIT 1;"
+    )
+    class_id, trainer = one(
+        "SELECT c.classid, c.trainerid FROM class c WHERE c.start > ? AND c.max > 0 "
+        "ORDER BY (SELECT COUNT(*) FROM attendee a WHERE a.classid = c.classid) DESC, c.classid LIMIT 1;",
+        now + 3600,
+    )
+    join_class, skill = one(
+        "SELECT c.classid, c.skillid FROM class c WHERE c.start > ? AND c.max > "
+        "(SELECT COUNT(*) FROM attendee a WHERE a.classid = c.classid AND a.status = 0) "
+        "ORDER BY c.classid LIMIT 1;",
+        now + 3600,
+    )
+    (joiner,) = one(
+        "SELECT userid FROM users WHERE userid NOT IN (SELECT trainerid FROM trainer WHERE skillid = ?) "
+        "AND userid NOT IN (SELECT a.userid FROM attendee a JOIN class c ON c.classid = a.classid "
+        "WHERE c.skillid = ?) ORDER BY userid LIMIT 1;",
+        skill,
+        skill,
+    )
+    leave_class, leaver = one(
+        "SELECT a.classid, a.userid FROM attendee a JOIN class c ON c.classid = a.classid "
+        "WHERE a.status = 0 AND c.start > ? AND c.max > 0 ORDER BY a.attendeeid LIMIT 1;",
+        now + 3600,
+    )
+    graded, grader = one(
+        "SELECT a.attendeeid, c.trainerid FROM attendee a JOIN class c ON c.classid = a.classid "
+        "WHERE a.status = 0 AND c.start < ? ORDER BY c.start DESC, a.attendeeid LIMIT 1;",
+        now,
+    )
+    db.executemany(
+        'INSERT INTO "session" (userid, magic) VALUES (?, ?);',
+        [(userid, MAGIC) for userid in {user, trainer, joiner, leaver, grader}],
+    )
+    db.commit()
+    return [
+        ("get_my_skills", "handle_get_my_skills_request", user, {}, False),
+        ("get_upcoming", "handle_get_upcoming_request", user, {}, False),
+        ("get_class", "handle_get_class_detail_request", trainer, {"id": class_id}, False),
+        ("join_class", "handle_join_class_request", joiner, {"id": join_class}, True),
+        ("leave_class", "handle_leave_class_request", leaver, {"id": leave_class}, True),
+        ("update_attendee", "handle_update_attendee_request", grader, {"id": graded, "state": "pass"}, True),
+        ("cancel_class", "handle_cancel_class_request", trainer, {"id": class_id}, True),
+    ]
+
+
+def replay(path, statements, write, repeat):
+    """Time each statement, count its VM steps and explain its plan."""
+    db = sqlite3.connect(path, isolation_level=None)
+    steps = [0]
+
+    def step():
+        steps[0] += STEP_GRANULARITY
+
+    results = [{"sql": sql, "times": [], "steps": 0, "plan": []} for sql in statements]
+    try:
+        for round in range(repeat + 1):
+            if write:
+                db.execute("BEGIN;")
+            for result in results:
+                if round == repeat:
+                    # The last round counts the steps, the progress handler slows statements down.
+                    steps[0] = 0
+                    db.set_progress_handler(step, STEP_GRANULARITY)
+                started = time.perf_counter()
+                db.execute(result["sql"]).fetchall()
+                elapsed = time.perf_counter() - started
+                db.set_progress_handler(None, 1)
+                if round == repeat:
+                    result["steps"] = steps[0]
+                else:
+                    result["times"].append(elapsed)
+            if write:
+                db.execute("ROLLBACK;")
+        for result in results:
+            result["plan"] = [
+                row[3] for row in db.execute("EXPLAIN QUERY PLAN " + result["sql"]).fetchall()
+            ]
+    finally:
+        db.close()
+    for result in results:
+        times = sorted(result.pop("times"))
+        result["ms"] = times[len(times) // 2] * 1000
+    return results
+
+
+def measure_scale(server, recorder, directory, scale, repeat):
+    path = os.path.join(directory, "scale%d.db" % scale)
+    sizes = {name: count * scale for name, count in BASE.items()}
+    generate_database(path, seed=scale, **sizes, **PER_SKILL)
+    db = sqlite3.connect(path)
+    commands = pick_samples(db)
+    db.close()
+
+    # Point the server at this database, revisions with per-process state rebuild it.
+    os.chdir(directory)
+    if os.path.exists("database.db"):
+        os.remove("database.db")
+    os.link(path, "database.db")
+    server.DATABASE_PATH = "database.db"
+    if hasattr(server, "_databases"):
+        server._databases.clear()
+    elif hasattr(server, "_database"):
+        server._database = None
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Warm up: prepares the schema and loads cached data on revisions that have them.
+        call_handler(server.handle_get_upcoming_request, str(commands[0][2]), MAGIC, {})
+
+    measured = {}
+    for name, handler, user, content, write in commands:
+        snapshot = sqlite3.connect(":memory:")
+        if write:
+            with contextlib.closing(sqlite3.connect(path)) as source:
+                source.backup(snapshot)
+        recorder.recording = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_handler(getattr(server, handler), str(user), MAGIC, content)
+        statements, recorder.recording = recorder.recording, None
+        if write:
+            with contextlib.closing(sqlite3.connect(path)) as target:
+                snapshot.backup(target)
+        snapshot.close()
+        measured[name] = replay(path, statements, write, repeat)
+    return measured
+
+
+def exponent(small, large, ratio):
+    if small <= 0 or large <= 0:
+        return 0.0
+    return math.log(large / small) / math.log(ratio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", default=os.path.join(ROOT, "server.py"))
+    parser.add_argument("--scales", default="10,100,1000")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    parser.add_argument("--plans", action="store_true", help="print every statement and its plan at the largest scale")
+    arguments = parser.parse_args()
+    scales = [int(scale) for scale in arguments.scales.split(",")]
+
+    recorder = Recorder()
+    sqlite3.connect = recorder
+    server = load_server(os.path.abspath(arguments.server))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            for name, statements in measure_scale(server, recorder, directory, scale, arguments.repeat).items():
+                results.setdefault(name, {})[str(scale)] = statements
+    sqlite3.connect = recorder.connect
+
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+
+    ratio = scales[-1] / scales[-2] if len(scales) > 1 else 1
+    header = "%-16s %5s" % ("command", "stmts")
+    for scale in scales:
+        header += " %9s %11s" % ("ms %dx" % scale, "steps %dx" % scale)
+    header += " %7s %7s" % ("exp ms", "exp st")
+    if baseline:
+        header += " %9s" % "vs base"
+    print(header)
+    flagged = []
+    for name, by_scale in results.items():
+        totals = {
+            scale: (sum(s["ms"] for s in statements), sum(s["steps"] for s in statements))
+            for scale, statements in by_scale.items()
+        }
+        line = "%-16s %5d" % (name, len(by_scale[str(scales[-1])]))
+        for scale in scales:
+            line += " %9.3f %11d" % totals[str(scale)]
+        notes = []
+        if len(scales) > 1:
+            small, large = totals[str(scales[-2])], totals[str(scales[-1])]
+            time_exponent = exponent(small[0], large[0], ratio)
+            step_exponent = exponent(small[1], large[1], ratio)
+            line += " %7.2f %7.2f" % (time_exponent, step_exponent)
+            if step_exponent > SUPER_LINEAR:
+                notes.append("super-linear")
+        if baseline and name in baseline and str(scales[-1]) in baseline[name]:
+            before = sum(s["steps"] for s in baseline[name][str(scales[-1])])
+            change = large[1] / before if before else float("inf")
+            line += " %8.2fx" % change
+            if change > 1.5:
+                notes.append("%.1fx the steps of the baseline" % change)
+            if len(scales) > 1 and str(scales[-2]) in baseline[name]:
+                before_small = sum(s["steps"] for s in baseline[name][str(scales[-2])])
+                if step_exponent - exponent(before_small, before, ratio) > 0.25:
+                    notes.append("grows faster than the baseline")
+        if notes:
+            flagged.append(name)
+            line += "  <- " + ", ".join(notes)
+        print(line)
+
+    if arguments.plans:
+        for name, by_scale in results.items():
+            print("\n%s at %dx" % (name, scales[-1]))
+            for statement in by_scale[str(scales[-1])]:
+                print("  %8.3f ms %10d steps  %s" % (statement["ms"], statement["steps"], statement["sql"][:160]))
+                for detail in statement["plan"]:
+                    print("      " + detail)
+
+    if arguments.save:
+        with open(arguments.save, "w") as file:
+            json.dump(results, file, indent=1)
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
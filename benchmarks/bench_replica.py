@@ -0,0 +1,121 @@
+"""Read latency from the database file and from the in-memory replica.
+
+Generates a database (see generate_database.py), opens it as the server does with
+--read-replica, and runs each read command's handler --repeat times against the file's
+read connections and against the replica. Prints the median and 95th percentile
+latency of both and the speedup, and how long loading a new copy of the file takes.
+--write-load commits small writes to the file from another thread while measuring, as
+a busy server would, and the replica reloads as they come in. Pass --server to measure
+another revision of server.py that has a replica.
+
+    python benchmarks/bench_replica.py --users 20000 --skills 100 --classes-per-skill 200 --write-load
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from bench_queries import MAGIC, pick_samples
+from common import load_server
+from generate_database import generate_database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(server, handler, user, content, readers, repeat):
+    """Latencies in ms of repeat calls of handler reading from readers."""
+    server.set_current_readers(readers)
+    times = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler(str(user), MAGIC, content)
+            for _ in range(repeat):
+                started = time.perf_counter()
+                handler(str(user), MAGIC, content)
+                times.append((time.perf_counter() - started) * 1000)
+    finally:
+        server.set_current_readers(None)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.95)]
+
+
+def write_forever(path, user, stop):
+    """Commit one small write after another until stop is set."""
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        while not stop.is_set():
+            db.execute("BEGIN IMMEDIATE;")
+            db.execute('UPDATE "session" SET magic = magic WHERE userid = ?;', (user,))
+            db.execute("COMMIT;")
+            time.sleep(0.001)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", default=os.path.join(ROOT, "server.py"))
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--skills", type=int, default=50)
+    parser.add_argument("--classes-per-skill", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--wal", action="store_true", help="put the file in WAL mode, as --workers does")
+    parser.add_argument("--write-load", action="store_true", help="commit writes to the file while measuring")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "database.db")
+        generate_database(
+            path,
+            seed=1,
+            users=arguments.users,
+            skills=arguments.skills,
+            classes_per_skill=arguments.classes_per_skill,
+        )
+        db = sqlite3.connect(path)
+        samples = pick_samples(db)
+        trainer = db.execute("SELECT trainerid FROM trainer ORDER BY trainerid LIMIT 1;").fetchone()[0]
+        db.execute('INSERT INTO "session" (userid, magic) VALUES (?, ?);', (trainer, MAGIC))
+        db.commit()
+        db.close()
+
+        os.chdir(directory)
+        server = load_server(os.path.abspath(arguments.server))
+        if arguments.wal:
+            with contextlib.redirect_stdout(io.StringIO()):
+                server.enable_wal_mode(path)
+        server.DATABASE_PATH = path
+        server.REPLICA_MAX_LAG = 1.0
+        database = server.get_database()
+        replica = database.replica
+        reload_seconds = replica.reload()
+
+        commands = [
+            (name, getattr(server, handler), user, content) for name, handler, user, content, write in samples if not write
+        ]
+        commands.append(("search_classes", server.handle_search_classes_request, samples[0][2], {"skill": "Skill 1"}))
+        commands.append(("get_analytics", server.handle_get_analytics_request, trainer, {}))
+
+        stop = threading.Event()
+        if arguments.write_load:
+            threading.Thread(target=write_forever, args=(path, trainer, stop), daemon=True).start()
+
+        print("database %.1f MB, loading a copy took %.3f s" % (os.path.getsize(path) / 2**20, reload_seconds))
+        print("%-16s %10s %10s %10s %10s %8s" % ("command", "file ms", "file p95", "copy ms", "copy p95", "speedup"))
+        for name, handler, user, content in commands:
+            file_median, file_p95 = measure(server, handler, user, content, database.readers, arguments.repeat)
+            copy_median, copy_p95 = measure(server, handler, user, content, replica, arguments.repeat)
+            print(
+                "%-16s %10.3f %10.3f %10.3f %10.3f %7.2fx"
+                % (name, file_median, file_p95, copy_median, copy_p95, file_median / copy_median)
+            )
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Encoding a large get_upcoming response: dicts and json.dumps versus the response records.
+
+Builds the class responses for --rows classes both ways, checks that the two texts are
+identical, and prints rows per second and the peak memory allocated per row (measured
+with tracemalloc) for each.
+
+    python benchmarks/bench_serialization.py --rows 10000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def legacy_response(rows):
+    """The response as the handlers built it before, one dict per class."""
+    response = [
+        {
+            "type": "class",
+            "id": id,
+            "name": name,
+            "trainer": trainer,
+            "when": when,
+            "notes": notes,
+            "size": size,
+            "max": max,
+            "action": action,
+        }
+        for id, name, trainer, when, notes, size, max, action in rows
+    ]
+    response.append({"type": "message", "code": 0, "text": "Upcoming Class Fetched, Success!!"})
+    return json.dumps(response)
+
+
+def record_response(rows):
+    response = [server.build_response_class(*row) for row in rows]
+    response.append(server.build_response_message(0, "Upcoming Class Fetched, Success!!"))
+    return server.encode_response(response)
+
+
+def make_rows(count, seed=1):
+    rng = random.Random(seed)
+    actions = ("join", "leave", "edit", "unavailable", "cancelled", None)
+    return [
+        (
+            classid,
+            "Skill %d" % rng.randint(1, 50),
+            rng.choice(("User %d" % rng.randint(1, 500), "Zoë O'Brien \"Trainer\"", None)),
+            1790000000 + rng.randint(0, 10**7),
+            "Room %d, bring notes\n" % rng.randint(1, 20),
+            rng.randint(0, 10),
+            10,
+            rng.choice(actions),
+        )
+        for classid in range(1, count + 1)
+    ]
+
+
+def measure(encode, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encode(rows)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    text = encode(rows)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(rows) / best, peak / len(rows), text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args(argv)
+
+    rows = make_rows(arguments.rows)
+    legacy_rate, legacy_bytes, legacy_text = measure(legacy_response, rows, arguments.repeat)
+    record_rate, record_bytes, record_text = measure(record_response, rows, arguments.repeat)
+    if legacy_text != record_text:
+        print("texts differ")
+        return 1
+    print("%-20s %14s %20s" % ("encoding", "rows/s", "peak bytes per row"))
+    print("%-20s %14.0f %20.0f" % ("dicts + json.dumps", legacy_rate, legacy_bytes))
+    print("%-20s %14.0f %20.0f" % ("response records", record_rate, record_bytes))
+    print("identical output, %d bytes" % len(record_text))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
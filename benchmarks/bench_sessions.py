@@ -0,0 +1,130 @@
+"""Login, session check and logout through every session store.
+
+Starts server.py against a fixture database once per --session-store backend
+(database, memory, sqlite and redis) and has users log in, fetch get_upcoming with
+their session and log out --round-trips times. Each round trip also checks that the
+session is accepted while logged in and refused after the logout, so a backend that
+loses or keeps sessions fails the run. Prints the median and 95th percentile latency
+of each step per backend. The servers run with --no-rate-limits, as the round trips
+log in far faster than the login rate allows. Redis runs against --redis if given,
+else against a small stand-in server for GET, SET and DEL started here.
+
+    python benchmarks/bench_sessions.py --round-trips 200 --redis redis://127.0.0.1:6379
+"""
+
+import argparse
+import os
+import socketserver
+import tempfile
+import threading
+import time
+
+from common import create_fixture_database, post_action, start_server
+
+
+class KeyValueHandler(socketserver.StreamRequestHandler):
+    """GET, SET, DEL and SELECT in the Redis protocol, on a dict shared by all connections."""
+
+    def handle(self):
+        values, lock = self.server.values, self.server.lock
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            words = []
+            for _ in range(int(line[1:-2])):
+                size = int(self.rfile.readline()[1:-2])
+                words.append(self.rfile.read(size + 2)[:-2].decode())
+            command = words[0].upper()
+            with lock:
+                if command == "GET":
+                    value = values.get(words[1])
+                    reply = b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value.encode()), value.encode())
+                elif command == "SET":
+                    values[words[1]] = words[2]
+                    reply = b"+OK\r\n"
+                elif command == "DEL":
+                    reply = b":%d\r\n" % (values.pop(words[1], None) is not None)
+                elif command == "SELECT":
+                    reply = b"+OK\r\n"
+                else:
+                    reply = b"-ERR unknown command '%s'\r\n" % command.encode()
+            self.wfile.write(reply)
+
+
+class KeyValueServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), KeyValueHandler)
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+def round_trip(port, userid):
+    """Log userid in, check the session with get_upcoming and log out. Returns the
+    latency in ms of each step, raising AssertionError if the store got one wrong."""
+    times = []
+    started = time.perf_counter()
+    records, cookies = post_action(port, "login", {"username": "user%d" % userid, "password": "pw"})
+    times.append((time.perf_counter() - started) * 1000)
+    assert records[0]["code"] == 0, records
+
+    started = time.perf_counter()
+    records, _ = post_action(port, "get_upcoming", {}, cookies)
+    times.append((time.perf_counter() - started) * 1000)
+    assert not any(record["type"] == "redirect" for record in records), "session refused after login"
+
+    started = time.perf_counter()
+    records, _ = post_action(port, "logout", {}, cookies)
+    times.append((time.perf_counter() - started) * 1000)
+    assert records[0]["code"] == 0, records
+
+    records, _ = post_action(port, "get_upcoming", {}, cookies)
+    assert records[0]["code"] == 200, "session accepted after logout"
+    return times
+
+
+def percentiles(times):
+    times = sorted(times)
+    return times[len(times) // 2], times[int(len(times) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--round-trips", type=int, default=100)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8093)
+    parser.add_argument("--redis", help="redis://<host>[:<port>][/<db>] of a real server instead of the stand-in")
+    arguments = parser.parse_args()
+
+    key_value_server = None
+    redis = arguments.redis
+    if redis is None:
+        key_value_server = KeyValueServer()
+        threading.Thread(target=key_value_server.serve_forever, daemon=True).start()
+        redis = "redis://127.0.0.1:%d" % key_value_server.server_address[1]
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_fixture_database(os.path.join(directory, "database.db"), users=arguments.users)
+        stores = ("database", "memory", "sqlite:" + os.path.join(directory, "sessions.db"), redis)
+        print("%-10s %10s %10s %10s %10s %10s %10s" % ("store", "login ms", "p95", "check ms", "p95", "logout ms", "p95"))
+        for store in stores:
+            server = start_server(directory, arguments.port, "--session-store", store, "--no-rate-limits")
+            try:
+                steps = ([], [], [])
+                for i in range(arguments.round_trips):
+                    for step, elapsed in zip(steps, round_trip(arguments.port, 1 + i % arguments.users)):
+                        step.append(elapsed)
+            finally:
+                server.terminate()
+                server.wait()
+            print("%-10s" % store.partition(":")[0] + "".join(" %10.3f %10.3f" % percentiles(step) for step in steps))
+
+    if key_value_server is not None:
+        key_value_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
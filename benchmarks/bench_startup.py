@@ -0,0 +1,126 @@
+"""Startup time and first-request latency, with and without the warm-up.
+
+Starts server.py --repeat times against a fixture database in each mode, measures how
+long it takes until it is ready (/ready answers 200, or the port accepts connections
+without the warm-up), and then the latency of login and of the first and second call
+of each read command.
+
+    python benchmarks/bench_startup.py --repeat 5 --classes-per-skill 200
+"""
+
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+from common import create_fixture_database, login, post_action
+
+COMMANDS = [("get_upcoming", {}), ("get_my_skills", {}), ("get_class", {"id": 1})]
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/ready")
+            reply = connection.getresponse()
+            body = reply.read()
+            connection.close()
+            if reply.status == 200:
+                return json.loads(body)
+        except OSError:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError("server on port %d did not become ready" % port)
+
+
+def wait_until_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            http.client.HTTPConnection("127.0.0.1", port, timeout=1).connect()
+            return {}
+        except OSError:
+            time.sleep(0.005)
+    raise RuntimeError("server on port %d did not start" % port)
+
+
+def start(directory, port, options):
+    """Start the server and return (process, seconds until ready, warm-up ms it reports).
+    Without the warm-up the server counts as ready once it accepts connections, as a
+    load balancer checking the port would see it; /ready would warm the database up."""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, common.SERVER, str(port), *options],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        ready = wait_until_listening(port) if "--no-warm-up" in options else wait_until_ready(port)
+    except BaseException:
+        process.kill()
+        raise
+    return process, time.perf_counter() - started, ready.get("warm_up_ms")
+
+
+def timed(port, command, content, cookies):
+    started = time.perf_counter()
+    post_action(port, command, content, cookies)
+    return (time.perf_counter() - started) * 1000
+
+
+def measure(directory, port, options, repeat):
+    rows = []
+    for attempt in range(repeat):
+        process, ready_after, warm_up_ms = start(directory, port + attempt, options)
+        try:
+            row = {"ready": ready_after * 1000, "warm_up": warm_up_ms or 0.0}
+            started = time.perf_counter()
+            cookies = login(port + attempt, 100)
+            row["login"] = (time.perf_counter() - started) * 1000
+            for command, content in COMMANDS:
+                row[command + " 1st"] = timed(port + attempt, command, content, cookies)
+            for command, content in COMMANDS:
+                row[command + " 2nd"] = timed(port + attempt, command, content, cookies)
+            rows.append(row)
+        finally:
+            process.terminate()
+            process.wait()
+    return {key: sorted(row[key] for row in rows)[len(rows) // 2] for key in rows[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8120)
+    parser.add_argument("--classes-per-skill", type=int, default=10)
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_fixture_database(
+            os.path.join(directory, "database.db"), classes_per_skill=arguments.classes_per_skill
+        )
+        # The first start adds the support tables, which is not part of a usual restart.
+        process, _, _ = start(directory, arguments.port, [])
+        process.terminate()
+        process.wait()
+        results = {
+            "cold": measure(directory, arguments.port + 10, ["--no-warm-up"], arguments.repeat),
+            "warm": measure(directory, arguments.port + 10 + arguments.repeat, [], arguments.repeat),
+        }
+
+    print("median milliseconds over %d starts" % arguments.repeat)
+    print("%-22s %10s %10s" % ("", "cold", "warm"))
+    for key in results["cold"]:
+        print("%-22s %10.1f %10.1f" % (key, results["cold"][key], results["warm"][key]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Write throughput with one connection and commit per write versus the group-committing writer.
+
+Several threads insert and delete attendee rows against a fixture database, first
+each write on its own connection (as the handlers used to), then through
+server.DatabaseWriter. Prints writes per second and the number of SQLITE_BUSY
+errors for both.
+
+    python benchmarks/bench_writes.py --threads 16 --writes 200
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from common import create_fixture_database  # noqa: E402
+
+
+def write_pair(cursor, attendeeid):
+    cursor.execute("INSERT INTO attendee (attendeeid, userid, classid, status) VALUES(?, 1, 1, 0);", (attendeeid,))
+    cursor.execute("UPDATE attendee SET status = 4 WHERE attendeeid = ?;", (attendeeid,))
+
+
+def per_connection(path, thread, writes, errors):
+    for i in range(writes):
+        db = sqlite3.connect(path, timeout=0.5)
+        try:
+            write_pair(db.cursor(), 10**6 + thread * writes + i)
+            db.commit()
+        except sqlite3.OperationalError:
+            errors.append(1)
+        finally:
+            db.close()
+
+
+def through_writer(writer, thread, writes, errors):
+    for i in range(writes):
+        attendeeid = 2 * 10**6 + thread * writes + i
+        try:
+            writer.execute(lambda cursor: write_pair(cursor, attendeeid))
+        except sqlite3.OperationalError:
+            errors.append(1)
+
+
+def measure(target, args, threads, writes):
+    errors = []
+    workers = [threading.Thread(target=target, args=(args, t, writes, errors)) for t in range(threads)]
+    began = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - began
+    return threads * writes / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--writes", type=int, default=200, help="writes per thread")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "database.db")
+        create_fixture_database(path)
+        server.enable_wal_mode(path)
+        print("%-16s %10s %12s" % ("mode", "writes/s", "busy errors"))
+        rate, errors = measure(per_connection, path, arguments.threads, arguments.writes)
+        print("%-16s %10.1f %12d" % ("per-connection", rate, errors))
+        rate, errors = measure(through_writer, server.DatabaseWriter(path), arguments.threads, arguments.writes)
+        print("%-16s %10.1f %12d" % ("group commit", rate, errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Shared helpers for the benchmarks: a fixture database, a server launcher and a small client."""
+
+import contextlib
+import http.client
+import importlib.util
+import inspect
+import io
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+SCHEMA = """
+CREATE TABLE users (userid INTEGER PRIMARY KEY, fullname TEXT, username TEXT, password TEXT);
+CREATE TABLE session (sessionid INTEGER PRIMARY KEY, userid INTEGER, magic INTEGER);
+CREATE TABLE skill (skillid INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE trainer (trainerid INTEGER, skillid INTEGER);
+CREATE TABLE class (classid INTEGER PRIMARY KEY, trainerid INTEGER, skillid INTEGER, start INTEGER, max INTEGER, note TEXT);
+CREATE TABLE attendee (attendeeid INTEGER PRIMARY KEY, userid INTEGER, classid INTEGER, status INTEGER);
+"""
+
+
+def create_fixture_database(path, users=200, skills=20, classes_per_skill=10, seed=1):
+    """Create database.db at path with users, skills, one trainer per skill and a
+    mix of past and future classes with attendees. Every user has password 'pw'."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    db.executemany(
+        "INSERT INTO users VALUES (?,?,?,?)",
+        ((u, "User %d" % u, "user%d" % u, "pw") for u in range(1, users + 1)),
+    )
+    db.executemany("INSERT INTO skill VALUES (?,?)", ((s, "Skill %d" % s) for s in range(1, skills + 1)))
+    db.executemany("INSERT INTO trainer VALUES (?,?)", ((s, s) for s in range(1, skills + 1)))
+    classid = 0
+    attendeeid = 0
+    for skillid in range(1, skills + 1):
+        for _ in range(classes_per_skill):
+            classid += 1
+            start = now + rng.randint(-60, 60) * 86400
+            db.execute(
+                "INSERT INTO class VALUES (?,?,?,?,?,?)",
+                (classid, skillid, skillid, start, 10, "Class %d" % classid),
+            )
+            for userid in rng.sample(range(skills + 1, users + 1), rng.randint(0, 8)):
+                attendeeid += 1
+                status = rng.choice((0, 1, 2)) if start < now else rng.choice((0, 0, 0, 4))
+                db.execute("INSERT INTO attendee VALUES (?,?,?,?)", (attendeeid, userid, classid, status))
+    db.commit()
+    db.close()
+
+
+def start_server(directory, port, *options):
+    """Start server.py with directory as working directory and wait until it accepts connections."""
+    process = subprocess.Popen(
+        [sys.executable, SERVER, str(port), *options],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            http.client.HTTPConnection("127.0.0.1", port, timeout=1).connect()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start on port %d" % port)
+
+
+def post_action(port, command, content=None, cookies=None):
+    """POST /action?command=... and return (response records, cookies set by the server)."""
+    body = json.dumps(content if content is not None else {})
+    headers = {"Content-Type": "application/json"}
+    if cookies:
+        headers["Cookie"] = "; ".join("%s=%s" % item for item in cookies.items())
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("POST", "/action?command=" + command, body, headers)
+        reply = connection.getresponse()
+        data = reply.read()
+        new_cookies = {}
+        for name, value in reply.getheaders():
+            if name.lower() == "set-cookie":
+                key, _, rest = value.strip().partition("=")
+                new_cookies[key] = rest.split(";")[0]
+        return json.loads(data) if data else [], new_cookies
+    finally:
+        connection.close()
+
+
+def login(port, userid):
+    """Log the fixture user in and return the session cookies."""
+    _, cookies = post_action(port, "login", {"username": "user%d" % userid, "password": "pw"})
+    return cookies
+
+
+def load_server(path):
+    """Import server.py from path without starting it."""
+    spec = importlib.util.spec_from_file_location("server_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+    return module
+
+
+def call_handler(handler, iuser, imagic, content):
+    """Call a handler of any revision: older handlers of read commands take no content."""
+    if len(inspect.signature(handler).parameters) == 2:
+        return handler(iuser, imagic)
+    return handler(iuser, imagic, content)
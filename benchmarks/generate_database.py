@@ -0,0 +1,191 @@
+"""Generate a synthetic training record database, deterministically from a seed.
+
+Creates the application tables (users, session, skill, trainer, class, attendee) and
+fills them with the given distributions, then adds the server's support tables, indexes
+and triggers so the file is ready to serve. The same seed and options always give the
+same rows. Every user has password 'pw'; sessions use userid as u_cookie and the magic
+stored in the session table.
+
+    python benchmarks/generate_database.py large.db --users 100000 --skills 500 \\
+        --classes-per-skill 1000 --seed 7
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+DAY = 86400
+
+# Attendee statuses: 0 enrolled, 1 passed, 2 failed, 3 cancelled by the user, 4 removed.
+STATUS_NAMES = {"enrolled": 0, "passed": 1, "failed": 2, "cancelled": 3, "removed": 4}
+
+
+def parse_mix(text):
+    """Parse 'passed=6,failed=2' into ([1, 2], [6.0, 2.0])."""
+    statuses, weights = [], []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in STATUS_NAMES:
+            raise argparse.ArgumentTypeError("unknown status %r" % name)
+        statuses.append(STATUS_NAMES[name.strip()])
+        weights.append(float(weight))
+    return statuses, weights
+
+
+def generate_database(
+    path,
+    seed=1,
+    users=1000,
+    skills=20,
+    trainers_per_skill=2,
+    users_per_skill=100,
+    classes_per_skill=50,
+    class_size=10,
+    fill=0.8,
+    past=0.7,
+    history_days=730,
+    future_days=90,
+    cancelled_classes=0.02,
+    past_mix="passed=6,failed=2,enrolled=1,cancelled=1,removed=1",
+    future_mix="enrolled=8,cancelled=1,removed=1",
+    sessions=100,
+    now=None,
+):
+    """Create the database at path (which must not exist) and return the number of rows
+    written to each table. now (default: the current time) anchors past and future
+    classes; pass it as well to reproduce a database exactly."""
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    rng = random.Random(seed)
+    now = int(time.time()) if now is None else now
+    past_statuses, past_weights = parse_mix(past_mix) if isinstance(past_mix, str) else past_mix
+    future_statuses, future_weights = parse_mix(future_mix) if isinstance(future_mix, str) else future_mix
+
+    # Who trains and who learns each skill is decided first, so the rows can be streamed.
+    skill_trainers = {}
+    skill_learners = {}
+    for skillid in range(1, skills + 1):
+        trainers = rng.sample(range(1, users + 1), min(trainers_per_skill, users))
+        skill_trainers[skillid] = trainers
+        learners = set(rng.sample(range(1, users + 1), min(users_per_skill + len(trainers), users)))
+        skill_learners[skillid] = sorted(learners.difference(trainers))[:users_per_skill]
+
+    counts = {}
+
+    def counted(table, rows):
+        counts[table] = 0
+        for row in rows:
+            counts[table] += 1
+            yield row
+
+    classes = []
+
+    def class_rows():
+        classid = 0
+        for skillid in range(1, skills + 1):
+            for _ in range(classes_per_skill):
+                classid += 1
+                if rng.random() < past:
+                    start = now - rng.randint(1, history_days * DAY)
+                else:
+                    start = now + rng.randint(DAY // 24, future_days * DAY)
+                start -= start % 900  # classes start on the quarter hour
+                capacity = rng.randint(max(1, class_size // 2), max(1, class_size * 3 // 2))
+                size = 0 if rng.random() < cancelled_classes else capacity
+                classes.append((classid, skillid, start, capacity))
+                yield (
+                    classid,
+                    rng.choice(skill_trainers[skillid]),
+                    skillid,
+                    start,
+                    size,
+                    "Room %d, session %d" % (rng.randint(1, 50), classid),
+                )
+
+    def attendee_rows():
+        attendeeid = 0
+        for classid, skillid, start, capacity in classes:
+            learners = skill_learners[skillid]
+            taken = min(len(learners), max(0, round(capacity * fill * rng.uniform(0.5, 1.5))), capacity)
+            if start < now:
+                statuses = rng.choices(past_statuses, past_weights, k=taken)
+            else:
+                statuses = rng.choices(future_statuses, future_weights, k=taken)
+            for userid, status in zip(rng.sample(learners, taken), statuses):
+                attendeeid += 1
+                yield (attendeeid, userid, classid, status)
+
+    started = time.perf_counter()
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        db.execute("PRAGMA journal_mode = OFF;")
+        db.execute("PRAGMA synchronous = OFF;")
+        db.execute("BEGIN;")
+        for statement in server.CORE_SCHEMA:
+            db.execute(statement)
+        db.executemany(
+            "INSERT INTO users VALUES (?, ?, ?, ?);",
+            counted("users", ((u, "User %d" % u, "user%d" % u, "pw") for u in range(1, users + 1))),
+        )
+        db.executemany(
+            "INSERT INTO skill VALUES (?, ?);",
+            counted("skill", ((s, "Skill %d" % s) for s in range(1, skills + 1))),
+        )
+        db.executemany(
+            "INSERT INTO trainer VALUES (?, ?);",
+            counted("trainer", ((t, s) for s in range(1, skills + 1) for t in skill_trainers[s])),
+        )
+        db.executemany("INSERT INTO class VALUES (?, ?, ?, ?, ?, ?);", counted("class", class_rows()))
+        db.executemany("INSERT INTO attendee VALUES (?, ?, ?, ?);", counted("attendee", attendee_rows()))
+        db.executemany(
+            'INSERT INTO "session" VALUES (?, ?, ?);',
+            counted(
+                "session",
+                ((u, u, rng.randrange(10**9, 10**10)) for u in range(1, min(sessions, users) + 1)),
+            ),
+        )
+        # The support tables and indexes are built once the rows are in, which is much
+        # faster than maintaining them while loading.
+        for statement in server.SUPPORT_SCHEMA:
+            db.execute(statement)
+        db.execute("COMMIT;")
+    finally:
+        db.close()
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="database file to create")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--skills", type=int, default=20)
+    parser.add_argument("--trainers-per-skill", type=int, default=2)
+    parser.add_argument("--users-per-skill", type=int, default=100, help="users who attend each skill's classes")
+    parser.add_argument("--classes-per-skill", type=int, default=50)
+    parser.add_argument("--class-size", type=int, default=10, help="typical class capacity, classes vary by half")
+    parser.add_argument("--fill", type=float, default=0.8, help="average share of a class's seats taken")
+    parser.add_argument("--past", type=float, default=0.7, help="share of classes that have already started")
+    parser.add_argument("--history-days", type=int, default=730)
+    parser.add_argument("--future-days", type=int, default=90)
+    parser.add_argument("--cancelled-classes", type=float, default=0.02)
+    parser.add_argument("--past-mix", type=parse_mix, default="passed=6,failed=2,enrolled=1,cancelled=1,removed=1")
+    parser.add_argument("--future-mix", type=parse_mix, default="enrolled=8,cancelled=1,removed=1")
+    parser.add_argument("--sessions", type=int, default=100, help="users 1..N get a session")
+    parser.add_argument("--now", type=int, help="unix time the classes are placed around (default: now)")
+    arguments = vars(parser.parse_args(argv))
+    counts = generate_database(arguments.pop("path"), **arguments)
+    print(", ".join("%s %s" % (table, count) for table, count in counts.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+"""The tests share the fixture database and server loader of the benchmarks."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
@@ -0,0 +1,187 @@
+"""Regression tests of the command handlers, run against a fixture database.
+
+The handlers are called through call_handler as the benchmarks call them, and whole
+commands through dispatch_command, so validation, the session check and the order of
+the records are checked without starting a server.
+
+    python -m pytest -q
+"""
+
+import os
+import sqlite3
+import time
+
+import pytest
+
+from common import SERVER, call_handler, create_fixture_database, load_server
+
+TRAINER = 1  # trains skill 1 of the fixture database
+STUDENT = 990  # has one attendance of each of skills 1 to 5
+
+
+def add_scenario(path):
+    """A class of skill 1 whose attendees' ids do not follow their statuses, and a
+    student with a passed, failed, pending and scheduled skill."""
+    now = int(time.time())
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO users VALUES (?,?,?,?)", [(u, "User %d" % u, "user%d" % u, "pw") for u in range(990, 996)])
+    db.execute("INSERT INTO class VALUES (9001, 1, 1, ?, 10, 'mixed')", (now - 86400,))
+    db.executemany(
+        "INSERT INTO attendee VALUES (?, ?, 9001, ?)",
+        [(900001, 991, 2), (900002, 992, 0), (900003, 993, 1), (900004, 994, 0), (900005, 995, 1)],
+    )
+    for skill_id, start, status in (
+        (3, now - 86400, 1),
+        (2, now - 86400, 2),
+        (5, now - 86400, 0),
+        (4, now + 86400, 0),
+        (1, now - 2 * 86400, 1),
+    ):
+        db.execute("INSERT INTO class VALUES (?, ?, ?, ?, 10, 'student')", (9100 + skill_id, skill_id, skill_id, start))
+        db.execute("INSERT INTO attendee VALUES (?, ?, ?, ?)", (910000 + skill_id, STUDENT, 9100 + skill_id, status))
+    db.commit()
+    db.close()
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("database")
+    create_fixture_database(str(directory / "database.db"))
+    add_scenario(str(directory / "database.db"))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield load_server(SERVER)
+    finally:
+        os.chdir(cwd)
+
+
+def records(response):
+    return [record.as_dict() for record in response[2]]
+
+
+def dispatch(server, command, user, magic, content):
+    return server.dispatch_command(server.CommandRequest(server.COMMANDS[command], user, magic, content, "127.0.0.1"))
+
+
+@pytest.mark.parametrize(
+    "command, content, message",
+    [
+        ("login", {"username": "user1"}, "Missing password parameter!"),
+        ("login", {"password": "pw"}, "Missing username parameter!"),
+        ("login", [], "Invalid request parameters!"),
+        ("get_class", {}, "Missing id parameter!"),
+        ("get_class", {"id": "one"}, "Invalid id parameter!"),
+        ("update_attendee", {"id": 1, "state": "absent"}, "Invalid state parameter!"),
+        ("create_class", {"id": 1, "note": "x", "max": 5, "day": 1, "month": 1, "year": 0, "hour": 9, "minute": 0}, "Invalid year parameter!"),
+    ],
+)
+def test_invalid_content_is_refused(server, command, content, message):
+    # do_POST answers these with message 101 and the text of the ValueError
+    with pytest.raises(ValueError) as error:
+        server.REQUEST_VALIDATORS[command](content)
+    assert str(error.value) == message
+
+
+def test_empty_credentials(server):
+    content = server.REQUEST_VALIDATORS["login"]({"username": "", "password": "pw"})
+    response = call_handler(server.handle_login_request, "", "", content)
+    assert records(response) == [{"type": "message", "code": 101, "text": "Please Enter Valid Credentials"}]
+
+
+def test_wrong_password(server):
+    response = call_handler(server.handle_login_request, "", "", {"username": "user1", "password": "wrong"})
+    assert records(response) == [{"type": "message", "code": 201, "text": "Invalid Credentials, Failed Login Attempt !!"}]
+
+
+@pytest.mark.parametrize(
+    "command, content",
+    [("get_upcoming", {}), ("get_my_skills", {}), ("get_class", {"id": 9001}), ("join_class", {"id": 9001})],
+)
+@pytest.mark.parametrize("user, magic", [("", ""), (str(TRAINER), ""), (str(TRAINER), "1234567890")])
+def test_not_logged_in(server, command, content, user, magic):
+    response = dispatch(server, command, user, magic, content)
+    assert response[:2] == ["!", ""]
+    assert records(response) == [
+        {"type": "message", "code": 200, "text": "Please, Login!"},
+        {"type": "redirect", "where": "/login.html"},
+    ]
+
+
+def test_login_then_logout(server):
+    iuser, imagic, response = dispatch(server, "login", "", "", {"username": "user%d" % STUDENT, "password": "pw"})
+    assert iuser == STUDENT
+    assert records([iuser, imagic, response])[0] == {"type": "message", "code": 0, "text": "Login Successful"}
+
+    response = dispatch(server, "get_my_skills", str(iuser), str(imagic), {})
+    assert records(response)[-1] == {"type": "message", "code": 0, "text": "Skills Fetched, Success!!"}
+
+    response = dispatch(server, "logout", str(iuser), str(imagic), {})
+    assert response[0] == "!"
+    response = dispatch(server, "get_my_skills", str(iuser), str(imagic), {})
+    assert records(response)[0] == {"type": "message", "code": 200, "text": "Please, Login!"}
+
+
+def test_class_attendees_by_status_then_id(server):
+    response = call_handler(server.handle_get_class_detail_request, str(TRAINER), "", {"id": 9001})
+    attendees = [record for record in records(response) if record["type"] == "attendee"]
+    assert [attendee["id"] for attendee in attendees] == [900002, 900004, 900003, 900005, 900001]
+    assert [attendee["action"] for attendee in attendees] == ["update", "update", "passed", "passed", "failed"]
+
+
+def test_class_of_another_trainer(server):
+    response = call_handler(server.handle_get_class_detail_request, str(TRAINER + 1), "", {"id": 9001})
+    assert records(response) == [{"type": "message", "code": 203, "text": "You're Not A Trainer For This Class"}]
+
+
+def test_skills_by_state_then_name(server):
+    response = call_handler(server.handle_get_my_skills_request, str(STUDENT), "", {})
+    skills = [(record["name"], record["state"]) for record in records(response) if record["type"] == "skill"]
+    assert skills == [
+        ("Skill 1", "passed"),
+        ("Skill 3", "passed"),
+        ("Skill 5", "pending"),
+        ("Skill 4", "scheduled"),
+        ("Skill 2", "failed"),
+    ]
+
+
+def test_trained_skills_come_first(server):
+    response = call_handler(server.handle_get_my_skills_request, str(TRAINER), "", {})
+    skills = [record for record in records(response) if record["type"] == "skill"]
+    assert (skills[0]["id"], skills[0]["state"]) == (1, "trainer")
+
+
+def test_upcoming_classes_by_start(server):
+    response = call_handler(server.handle_get_upcoming_request, str(STUDENT), "", {})
+    classes = [record for record in records(response) if record["type"] == "class"]
+    now = time.time()
+    assert classes
+    assert all(record["when"] > now for record in classes)
+    assert [record["when"] for record in classes] == sorted(record["when"] for record in classes)
+    assert records(response)[-1] == {"type": "message", "code": 0, "text": "Upcoming Class Fetched, Success!!"}
+
+
+def test_analytics_split_enrolled_attendees(server):
+    response = call_handler(server.handle_get_analytics_request, str(TRAINER), "", {"skill": 1})
+    total = records(response)[-2]
+    assert (total["id"], total["trainer"]) == (1, None)
+    db = sqlite3.connect("database.db")
+    try:
+        upcoming, no_show = db.execute(
+            "SELECT TOTAL(c.start > unixepoch('now')), TOTAL(c.start <= unixepoch('now')) FROM attendee a JOIN class c ON c.classid = a.classid WHERE c.skillid = 1 AND a.status = 0;"
+        ).fetchone()
+    finally:
+        db.close()
+    # attendees 900002 and 900004 of the past class 9001 were never graded
+    assert no_show >= 2
+    assert (total["upcoming"], total["no_show"]) == (upcoming, no_show)
+
+
+def test_analytics_of_every_skill_for_managers(server):
+    response = call_handler(server.handle_get_analytics_request, str(STUDENT), "", {})
+    assert records(response) == [{"type": "message", "code": 203, "text": "You're Not A Trainer For This Skill"}]
+    server.do_database_execute_parameterised("INSERT INTO manager (userid) VALUES (?);", (STUDENT,))
+    response = call_handler(server.handle_get_analytics_request, str(STUDENT), "", {})
+    totals = [record["id"] for record in records(response) if record["type"] == "stats" and record["trainer"] is None]
+    assert totals == list(range(1, 21))